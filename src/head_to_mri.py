@@ -1,13 +1,15 @@
 import os
 import vedo
+import threading
 import numpy as np
 import easygui as eg
 from tkinter.filedialog import askopenfilename
 
 import transform_vars
-from point_data import process_meshes
+from point_data import process_meshes, ProcessedMesh
 from trans_plot_funcs import instantiate_plotter
-from point_traversal import find_landmarks
+from point_traversal import find_landmarks, LANDMARK_TOLERANCE
+from progress import ProgressReporter, CancelToken, Cancelled, SAVING
 
 def run():
     path = load_meshes()
@@ -21,9 +23,20 @@ def run():
         ).interactive()
         transform_vars.plotter.render()
 
-        # Crop meshes and find landmarks
-        m_mesh, h_mesh = process_meshes()
-        mri_landmarks, head_landmarks = find_landmarks(m_mesh, h_mesh)
+        # Clone meshes on this thread, as the originals are rendered while the clones are processed
+        m_clone = transform_vars.mri_mesh.clone()
+        h_clone = transform_vars.head_mesh.clone()
+
+        # Crop meshes and find landmarks, returning to point selection if cancelled
+        try:
+            m_mesh, h_mesh, mri_landmarks, head_landmarks = run_with_progress(
+                transform_vars.plotter,
+                lambda progress: process_and_find_landmarks(m_clone, h_clone, progress)
+            )
+        except Cancelled:
+            transform_vars.plotter.close()
+            transform_vars.plotter.remove()
+            continue
 
         # Plotter to show identified landmarks
         landmark_plotter = vedo.Plotter(shape=[1,2], axes=True, bg="blackboard", sharecam=True)
@@ -34,7 +47,7 @@ def run():
         to_exclude = []
         for index, mri_lmark in enumerate(mri_landmarks):
             head_lmark = head_landmarks[index]
-            if np.linalg.norm(mri_lmark - head_lmark) > 0.015:
+            if np.linalg.norm(mri_lmark - head_lmark) > LANDMARK_TOLERANCE:
                 to_exclude.append(index)
                 colour = "yellow5"
             else:
@@ -92,11 +105,14 @@ def run():
 
         # Save files if choice is "yes", leaving windows open
         if coreg_complete_choice == coreg_complete_choices[0]:
-            np.savetxt(path+"_mri_to_fiducial.tsv", m_mesh.trans_matrix, delimiter='\t')
-            np.savetxt(path+"_head_to_fiducial.tsv", h_mesh.trans_matrix, delimiter='\t')
-            np.savetxt(path+"_head_fiducial_to_mri.tsv", h_tform, delimiter='\t')
-            vedo.file_io.write(final_mri, path+"_alligned_mri.ply")
-            vedo.file_io.write(final_head, path+"_alligned_head.ply")
+            # Saving cannot be cancelled, so that outputs are never left partly written
+            run_with_progress(
+                transform_vars.plotter,
+                lambda progress: save_alignment(
+                    path, m_mesh, h_mesh, h_tform, final_mri, final_head, progress
+                ),
+                cancellable=False
+            )
             break
 
         # Close all plotter objects
@@ -112,6 +128,75 @@ def run():
             break
     
     
+# Runs the work which is too slow for the UI thread, returning its meshes and landmarks
+def process_and_find_landmarks(
+    m_mesh: vedo.Mesh, h_mesh: vedo.Mesh, progress: ProgressReporter
+):
+    m_mesh, h_mesh = process_meshes(m_mesh, h_mesh, progress)
+    mri_landmarks, head_landmarks = find_landmarks(m_mesh, h_mesh, progress)
+
+    return m_mesh, h_mesh, mri_landmarks, head_landmarks
+
+# Saves transformation matrices and aligned meshes
+def save_alignment(
+    path: str,
+    m_mesh: ProcessedMesh,
+    h_mesh: ProcessedMesh,
+    h_tform: np.ndarray,
+    final_mri: vedo.Mesh,
+    final_head: vedo.Mesh,
+    progress: ProgressReporter = None
+):
+    progress = progress or ProgressReporter()
+    progress.start(SAVING, 5)
+
+    np.savetxt(path+"_mri_to_fiducial.tsv", m_mesh.trans_matrix, delimiter='\t')
+    progress.advance()
+    np.savetxt(path+"_head_to_fiducial.tsv", h_mesh.trans_matrix, delimiter='\t')
+    progress.advance()
+    np.savetxt(path+"_head_fiducial_to_mri.tsv", h_tform, delimiter='\t')
+    progress.advance()
+    vedo.file_io.write(final_mri, path+"_alligned_mri.ply")
+    progress.advance()
+    vedo.file_io.write(final_head, path+"_alligned_head.ply")
+    progress.finish()
+
+"""
+Calls work with a ProgressReporter in a background thread, showing its progress in the
+plotter and keeping the window responsive until it finishes. If cancellable, Cancelled is raised
+if the user cancels with CTRL + X
+"""
+def run_with_progress(plotter: vedo.Plotter, work, cancellable: bool = True):
+    token = CancelToken()
+    hint = "\nCTRL + X to cancel" if cancellable else ""
+    status = {"text": "Processing"}
+    outcome = {}
+
+    def report(stage: str, fraction: float, eta: float):
+        eta_text = f" ({eta:.0f}s remaining)" if eta is not None else ""
+        status["text"] = f"{stage}: {fraction:.0%}{eta_text}"
+
+    def target():
+        try:
+            outcome["result"] = work(ProgressReporter(report, token if cancellable else None))
+        except Exception as error:
+            outcome["error"] = error
+
+    # Input is handled while waiting, so the token is set to let the callbacks ignore it
+    transform_vars.cancel_token = token
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    while worker.is_alive():
+        transform_vars.info_txt.text(status["text"] + hint)
+        plotter.render()
+        plotter.process_events()
+        worker.join(0.05)
+    transform_vars.cancel_token = None
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
 # Returns head mesh and MRI mesh, after loading from disk
 def load_meshes():
     in_dir = os.path.normpath(os.path.dirname(__file__) + "\\data")
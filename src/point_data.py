@@ -5,6 +5,7 @@ from typing import NamedTuple
 from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk
 
 import transform_vars
+from progress import ProgressReporter, PROCESSING_MRI, PROCESSING_HEAD
 
 # Stores mesh point data for later traversal
 class Point(NamedTuple):
@@ -12,153 +13,224 @@ class Point(NamedTuple):
     coords: list
     connected_points: set
 
+"""
+Mesh point data, with Point objects built on access from the connection arrays. owner is kept
+alive for as long as the points are, for arrays backed by memory that it manages
+"""
+class MeshPoints:
+    def __init__(
+        self,
+        coords: np.ndarray,
+        adjacency_ptr: np.ndarray,
+        adjacency: np.ndarray,
+        owner: object = None
+    ):
+        self.coords = coords
+        self.adjacency_ptr = adjacency_ptr
+        self.adjacency = adjacency
+        self.owner = owner
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    def __getitem__(self, index: int) -> Point:
+        index = int(index)
+        if not 0 <= index < len(self.coords):
+            raise IndexError(index)
+        start, end = self.adjacency_ptr[index], self.adjacency_ptr[index+1]
+        connected = frozenset(self.adjacency[start:end].tolist())
+
+        return Point(index, self.coords[index], connected)
+
 # Stores data relevant to a processed mesh
 class ProcessedMesh(NamedTuple):
     mesh: vedo.Mesh
-    points: list[Point]
+    points: MeshPoints
     nasal_tip: Point
     rpa: list[float]
     lpa: list[float]
     trans_matrix: list[list[float]]
 
-# Prepares both meshes for landmark identification
-def process_meshes() -> tuple[ProcessedMesh, ProcessedMesh]:
-    m_mesh = transform_vars.mri_mesh.clone()
-    h_mesh = transform_vars.head_mesh.clone()
-
-    pro_m_mesh = process_mri_mesh(m_mesh, transform_vars.mri_fiducial)
-    pro_h_mesh = process_head_mesh(h_mesh, transform_vars.head_fiducial, pro_m_mesh.mesh)
+# Prepares both meshes for landmark identification, modifying the meshes passed in
+def process_meshes(
+    m_mesh: vedo.Mesh,
+    h_mesh: vedo.Mesh,
+    progress: ProgressReporter = None
+) -> tuple[ProcessedMesh, ProcessedMesh]:
+    pro_m_mesh = process_mri_mesh(m_mesh, transform_vars.mri_fiducial, progress)
+    pro_h_mesh = process_head_mesh(
+        h_mesh, transform_vars.head_fiducial, pro_m_mesh.mesh, progress
+    )
 
     return pro_m_mesh, pro_h_mesh
 
-# Prepares MRI mesh for alignment
+"""
+Prepares MRI mesh for alignment. trans_matrix may be given if it has already been calculated
+for the fiducials, and smooth set to False if the mesh has already been smoothed (smoothing is
+unaffected by the rigid transform into fiducial space)
+"""
 def process_mri_mesh(
     mesh: vedo.Mesh,
-    fiducial_points: dict[str, list[float]]
+    fiducial_points: dict[str, list[float]],
+    progress: ProgressReporter = None,
+    trans_matrix: np.ndarray = None,
+    smooth: bool = True
 ) -> ProcessedMesh:
-    trans_mesh, n_tip, lpa, rpa, trans_matrix = transform_mesh_fiducial(mesh, fiducial_points)
-    trans_mesh.smooth()
+    # Work is counted per processing step
+    progress = progress or ProgressReporter()
+    progress.start(PROCESSING_MRI, 4)
+
+    trans_mesh, n_tip, lpa, rpa, trans_matrix = transform_mesh_fiducial(
+        mesh, fiducial_points, trans_matrix
+    )
+    progress.advance()
+    if smooth:
+        trans_mesh.smooth()
+    progress.advance()
 
     # Cut below nasal tip
     trans_mesh.cut_with_plane(n_tip, [0,0,1])
+    progress.advance()
 
-    points, nasal_tip = extract_point_data_and_ntip(trans_mesh, n_tip)
+    points, nasal_tip = extract_point_data_and_ntip(trans_mesh, n_tip, progress)
+    progress.finish()
 
     return ProcessedMesh(trans_mesh, points, nasal_tip, rpa, lpa, trans_matrix)
 
-# Prepares head mesh for alignment
+# Prepares head mesh for alignment, optionally with an already calculated trans_matrix
 def process_head_mesh(
     head_mesh: vedo.Mesh,
     fiducial_points: dict[str, list[float]],
-    mri_mesh: vedo.Mesh
+    mri_mesh: vedo.Mesh,
+    progress: ProgressReporter = None,
+    trans_matrix: np.ndarray = None
 ) -> ProcessedMesh:
+    # Work is counted per processing step
+    progress = progress or ProgressReporter()
+    progress.start(PROCESSING_HEAD, 4)
+
     trans_mesh, n_tip, lpa, rpa, trans_matrix = transform_mesh_fiducial(
-        head_mesh, fiducial_points
+        head_mesh, fiducial_points, trans_matrix
     )
+    progress.advance()
     # Cut below nasal tip
     trans_mesh.cut_with_plane(n_tip, [0,0,1])
+    progress.advance()
     
     # Find max z for mri mesh - to account for helmet/cap being worn
     mri_coords = vtk_to_numpy(mri_mesh.polydata().GetPoints().GetData())
-    max_z = sys.float_info.min
-    max_z_coords = []
-    for coords in mri_coords:
-        if coords[2] > max_z:
-            max_z = coords[2]
-            max_z_coords = coords
+    max_z_coords = mri_coords[np.argmax(mri_coords[:, 2])]
     # Cut above max z
     trans_mesh.cut_with_plane(max_z_coords, [0,0,-1])
+    progress.advance()
 
-    points, nasal_tip = extract_point_data_and_ntip(trans_mesh, n_tip)
+    points, nasal_tip = extract_point_data_and_ntip(trans_mesh, n_tip, progress)
+    progress.finish()
     
     return ProcessedMesh(trans_mesh, points, nasal_tip, rpa, lpa, trans_matrix)
 
-# Creates Point objects with their mesh index and coordinates and finds nasal tip
+# Creates point data for the mesh and finds nasal tip
 def extract_point_data_and_ntip(
     cropped_mesh: vedo.Mesh, 
-    n_coords: list[float]
-) -> tuple[list[Point], Point]:
+    n_coords: list[float],
+    progress: ProgressReporter = None
+) -> tuple[MeshPoints, Point]:
     pd = cropped_mesh.polydata()
     coords = vtk_to_numpy(pd.GetPoints().GetData())
     bounds = cropped_mesh.GetBounds()
     z_range = bounds[5] - bounds[4]
     z_limit = n_coords[2] + z_range/10
 
-    # Set up points and find true nasal tip
-    points = []
-    nasal_tip_index = 0
-    max_x = sys.float_info.min
-    for index, coord in enumerate(coords):
-        # Nasal tip is point with greatest x within bounds for z
-        if coord[0] > max_x and coord[2] < z_limit:
-            nasal_tip_index = index
-            max_x = coord[0]
-        points.append(Point(index, coord, set()))
-    points = extract_connection_info(pd, points)
+    # Nasal tip is point with greatest (positive) x within bounds for z
+    candidates = np.flatnonzero((coords[:, 2] < z_limit) & (coords[:, 0] > sys.float_info.min))
+    nasal_tip_index = candidates[np.argmax(coords[candidates, 0])] if len(candidates) else 0
+
+    adjacency_ptr, adjacency = extract_connection_info(pd, progress)
+    points = MeshPoints(coords, adjacency_ptr, adjacency)
 
     return points, points[nasal_tip_index]
 
-# Finds connections between each point and adds them to each Point object
-def extract_connection_info(point_data, points: list[Point]) -> list[Point]:
-    poly_data = point_data.GetPolys().GetData()
-    values = [int(poly_data.GetTuple1(i)) for i in range(poly_data.GetNumberOfTuples())]
+"""
+Finds connections between each point, returned in compressed sparse row form: the points
+connected to point i are adjacency[adjacency_ptr[i]:adjacency_ptr[i+1]]
+"""
+def extract_connection_info(
+    point_data,
+    progress: ProgressReporter = None
+) -> tuple[np.ndarray, np.ndarray]:
+    progress = progress or ProgressReporter()
+    n_points = point_data.GetNumberOfPoints()
 
     # Assumes that polygons are all triangles
-    num_triangles = int(len(values) / 4)
-    for i in range(num_triangles):
-        # Extract Triangle information
-        tuple_start = i*4+1
-        tuple_end = tuple_start + 3
-        triangle_points = values[tuple_start:tuple_end]
-        
-        # Update Point objects with connections
-        point_set = set(triangle_points)
-        for point in triangle_points:
-            points[point].connected_points.update(point_set.difference([point]))
-
-    return points
-
-# Transforms mesh into desired coordinate space and finds nasal tip
+    triangles = vtk_to_numpy(point_data.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+
+    # Each point of a triangle is connected to the other two
+    starts = triangles[:, [0, 0, 1, 1, 2, 2]].ravel().astype(np.int64)
+    ends = triangles[:, [1, 2, 0, 2, 0, 1]].ravel().astype(np.int64)
+    progress.check()
+
+    # Remove connections repeated by triangles sharing an edge, sorting by start point
+    starts, ends = np.divmod(np.unique(starts * n_points + ends), n_points)
+    progress.check()
+
+    adjacency_ptr = np.zeros(n_points + 1, dtype=np.int64)
+    np.cumsum(np.bincount(starts, minlength=n_points), out=adjacency_ptr[1:])
+
+    return adjacency_ptr, ends
+
+# Transforms mesh into desired coordinate space, calculating the transform if not given
 def transform_mesh_fiducial(
     mesh: vedo.Mesh, 
-    fiducial_points: dict[str, list[float]]
+    fiducial_points: dict[str, list[float]],
+    trans_matrix: np.ndarray = None
 ) -> tuple[vedo.Mesh, list[float], list[float], list[float], list[list[float]]]:
     nasal = fiducial_points["nasal_tip"]
     rpa = fiducial_points["rpa_pt"]
     lpa = fiducial_points["lpa_pt"]
-    
+    if trans_matrix is None:
+        trans_matrix = fiducial_transforms(nasal, rpa, lpa)
+
+    # Transform fiducial points and mesh (1 has to be appended to point coord vectors)
+    nasal = np.dot(trans_matrix, np.append(nasal,1))[:-1]
+    lpa = np.dot(trans_matrix, np.append(lpa,1))[:-1]
+    rpa = np.dot(trans_matrix, np.append(rpa,1))[:-1]
+    mesh.apply_transform(trans_matrix, reset=True)
+
+    return mesh, nasal, rpa, lpa, trans_matrix
+
+"""
+Calculates the transformation matrix into fiducial space for one or many sets of fiducials.
+Each argument may be a single coordinate of shape (3,) or a stack of shape (N, 3), in which
+case a stack of N 4x4 matrices is returned
+"""
+def fiducial_transforms(
+    nasal: np.ndarray,
+    rpa: np.ndarray,
+    lpa: np.ndarray
+) -> np.ndarray:
+    nasal = np.asarray(nasal, dtype=float)
+    rpa = np.asarray(rpa, dtype=float)
+    lpa = np.asarray(lpa, dtype=float)
+
     right = rpa - lpa
-    right_unit = right / np.linalg.norm(right)
+    right_unit = right / np.linalg.norm(right, axis=-1, keepdims=True)
     left_unit = -right_unit
 
     # Origin falls on the line through nasion and perpendicular to the left-right axis
-    origin = lpa + np.dot(nasal - lpa, right_unit) * right_unit
+    origin = lpa + np.sum((nasal - lpa) * right_unit, axis=-1, keepdims=True) * right_unit
 
     # Calculate the line perpentidular to the left-right axis
     anterior = nasal - origin
-    anterior_unit = anterior / np.linalg.norm(anterior)
+    anterior_unit = anterior / np.linalg.norm(anterior, axis=-1, keepdims=True)
 
     # Calculate direction perpendicular to right and anterior
     superior_unit = np.cross(right_unit, anterior_unit)
 
-    # Translation to the origin
-    origin_translation = np.eye(4)
-    for i in range(3):
-        origin_translation[i,3] = -origin[i]
-
-    rotation_matrix = np.empty([4,4])
-    rotation_matrix[0] = np.append(anterior_unit,0)
-    rotation_matrix[1] = np.append(left_unit,0)
-    rotation_matrix[2] = np.append(superior_unit,0)
-    rotation_matrix[3] = [0, 0, 0, 1]
+    # Rows of the rotation are the new axes; translation moves the origin to zero
+    rotation = np.stack([anterior_unit, left_unit, superior_unit], axis=-2)
+    trans_matrix = np.zeros(nasal.shape[:-1] + (4, 4))
+    trans_matrix[..., :3, :3] = rotation
+    trans_matrix[..., :3, 3] = -np.einsum("...ij,...j->...i", rotation, origin)
+    trans_matrix[..., 3, 3] = 1
 
-    # Combine two matrices into one transformation matrix
-    trans_matrix = np.dot(rotation_matrix, origin_translation)
-
-    # Transform fiducial points and mesh (1 has to be appended to point coord vectors)
-    nasal = np.dot(trans_matrix, np.append(nasal,1))[:-1]
-    lpa = np.dot(trans_matrix, np.append(lpa,1))[:-1]
-    rpa = np.dot(trans_matrix, np.append(rpa,1))[:-1]
-    mesh.apply_transform(trans_matrix, reset=True)
-
-    return mesh, nasal, rpa, lpa, trans_matrix
+    return trans_matrix
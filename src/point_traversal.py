@@ -2,7 +2,11 @@ import vedo
 from enum import Enum
 from collections import deque
 
-from point_data import Point, ProcessedMesh
+from point_data import Point, MeshPoints, ProcessedMesh
+from progress import ProgressReporter, FINDING_LANDMARKS
+
+# Landmarks further apart than this (in metres) between meshes are excluded from alignment
+LANDMARK_TOLERANCE = 0.015
 
 # Represents whether x is maximised or minimised during search
 class Target(Enum):
@@ -11,15 +15,22 @@ class Target(Enum):
 
 # Returns coordinates of common landmarks in both meshes for plotting and transformation
 def find_landmarks(
-    mri_mesh: ProcessedMesh, head_mesh: ProcessedMesh
+    mri_mesh: ProcessedMesh,
+    head_mesh: ProcessedMesh,
+    progress: ProgressReporter = None
 ) -> tuple[list[float], list[float]]:
-    mri_landmarks = find_non_bridge_landmarks(mri_mesh)
-    head_landmarks = find_non_bridge_landmarks(head_mesh)
+    # Work is counted per point search: five for each mesh and then one on each nose bridge
+    progress = progress or ProgressReporter()
+    progress.start(FINDING_LANDMARKS, 12)
+
+    mri_landmarks = find_non_bridge_landmarks(mri_mesh, progress)
+    head_landmarks = find_non_bridge_landmarks(head_mesh, progress)
 
     # Find common point on nose bridge
     mri_bridge, head_bridge = find_common_nasal_bridge(
-        [mri_mesh, head_mesh], [mri_landmarks[0], head_landmarks[0]]
+        [mri_mesh, head_mesh], [mri_landmarks[0], head_landmarks[0]], progress
     )
+    progress.finish()
     mri_landmarks.append(mri_bridge)
     head_landmarks.append(head_bridge)
 
@@ -31,7 +42,9 @@ def find_landmarks(
 
     return mri_landmark_coords, head_landmarks_coords
 
-def find_non_bridge_landmarks(pro_mesh: ProcessedMesh) -> list[int]:
+def find_non_bridge_landmarks(
+    pro_mesh: ProcessedMesh, progress: ProgressReporter = None
+) -> list[int]:
     points = pro_mesh.points
     bounds = pro_mesh.mesh.GetBounds()
     
@@ -46,41 +59,53 @@ def find_non_bridge_landmarks(pro_mesh: ProcessedMesh) -> list[int]:
         
     )
     # Locate nasion point by minimising x from the nasal tip within the bounds for y and z
-    nasion_point = find_point(points, pro_mesh.nasal_tip, Target.MIN, y_bounds, z_bounds)
+    nasion_point = find_point(
+        points, pro_mesh.nasal_tip, Target.MIN, y_bounds, z_bounds, progress
+    )
 
     # Find left endocanthion
     y_bounds, z_bounds = set_bounds(
         nasion_point, y_range, z_range, y_min_divisor=None, y_max_divisor=20,
         z_min_divisor=10, z_max_divisor=None 
     )
-    left_endocanthion = find_point(points, nasion_point, Target.MIN, y_bounds, z_bounds)
+    left_endocanthion = find_point(
+        points, nasion_point, Target.MIN, y_bounds, z_bounds, progress
+    )
 
     # Find right endocanthion
     y_bounds, z_bounds = set_bounds(
         nasion_point, y_range, z_range, y_min_divisor=20, y_max_divisor=None,
         z_min_divisor=10, z_max_divisor=None
     )
-    right_endocanthion = find_point(points, nasion_point, Target.MIN, y_bounds, z_bounds)
+    right_endocanthion = find_point(
+        points, nasion_point, Target.MIN, y_bounds, z_bounds, progress
+    )
     
     # Find forehead point above left endocanthion
     y_bounds, z_bounds = set_bounds(
         left_endocanthion, y_range, z_range, y_min_divisor=100, y_max_divisor=100,
         z_min_divisor=None, z_max_divisor=5
     )
-    forehead_left = find_point(points, left_endocanthion, Target.MAX, y_bounds, z_bounds)
+    forehead_left = find_point(
+        points, left_endocanthion, Target.MAX, y_bounds, z_bounds, progress
+    )
 
     # Find forehead point above right endocanthion
     y_bounds, z_bounds = set_bounds(
         right_endocanthion, y_range, z_range, y_min_divisor=100, y_max_divisor=100,
         z_min_divisor=None, z_max_divisor=5
     )
-    forehead_right = find_point(points, right_endocanthion, Target.MAX, y_bounds, z_bounds)
+    forehead_right = find_point(
+        points, right_endocanthion, Target.MAX, y_bounds, z_bounds, progress
+    )
 
     return [nasion_point, left_endocanthion, right_endocanthion, 
             forehead_left, forehead_right]
 
 # Noses can be warped by MRI: a point guaranteed to be common to both meshes has to be found
-def find_common_nasal_bridge(meshes: list[ProcessedMesh], nasions: list[Point]) -> tuple[Point]:
+def find_common_nasal_bridge(
+    meshes: list[ProcessedMesh], nasions: list[Point], progress: ProgressReporter = None
+) -> tuple[Point]:
     mri_tip = meshes[0].nasal_tip
     head_tip = meshes[1].nasal_tip
     mri_nasion = nasions[0]
@@ -108,7 +133,7 @@ def find_common_nasal_bridge(meshes: list[ProcessedMesh], nasions: list[Point])
         # Use calculated minimum for z
         z_bounds = (z_min, z_start)
         nasal_bridge_points[index] = find_point(
-            pro_mesh.points, nasion, Target.MAX, y_bounds, z_bounds
+            pro_mesh.points, nasion, Target.MAX, y_bounds, z_bounds, progress
         )
 
     return (nasal_bridge_points[0], nasal_bridge_points[1])
@@ -142,11 +167,12 @@ def set_bounds(
 
 # Finds a point given a start point, a target for x, and bounds for y and z
 def find_point(
-    points: list[Point],
+    points: MeshPoints,
     start_point: Point, 
     x_target: Target, 
     y_bounds: tuple[float], 
-    z_bounds: tuple[float]
+    z_bounds: tuple[float],
+    progress: ProgressReporter = None
 ) -> Point:
     """ 
     Keep track of indexes of points that are queued, have already been visited or are known to 
@@ -173,8 +199,14 @@ def find_point(
     
     point_unnacounted = lambda x: not(x in queued or x in visited or x in out_of_bounds)
 
+    progress = progress or ProgressReporter()
+
     # Loop until queue is empty
     while len(queue) > 0:
+        # Allow long traversals to be cancelled
+        if len(visited) % 1024 == 0:
+            progress.check()
+
         # print(queue)
         # Set current point and remove from queue
         current_point_index = queue.popleft()
@@ -204,6 +236,7 @@ def find_point(
                 else:
                     out_of_bounds.add(point)
 
+    progress.advance()
     return points[predicted_point]
 
 def point_in_bounds(point: Point, y_bounds: tuple[float], z_bounds: tuple[float]) -> bool:
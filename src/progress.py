@@ -0,0 +1,111 @@
+import time
+import threading
+from typing import Callable
+
+# Names of the pipeline stages, used both when reporting progress and when setting deadlines
+PROCESSING_MRI = "Processing MRI mesh"
+PROCESSING_HEAD = "Processing head mesh"
+FINDING_LANDMARKS = "Finding landmarks"
+SAVING = "Saving"
+SAMPLING_ALIGNMENTS = "Sampling alignments"
+
+# Raised from within a pipeline stage once its cancel token has been triggered
+class Cancelled(Exception):
+    pass
+
+# Raised when a stage runs for longer than the deadline it was given
+class DeadlineExceeded(Cancelled):
+    pass
+
+# Cooperative cancellation flag, safe to trigger from another thread (e.g. the UI)
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+"""
+Passed through long running stages to report progress and check for cancellation.
+
+callback is called with the stage name, the fraction of the stage completed and the estimated
+seconds remaining (None until it can be estimated). deadlines maps stage names to the number of
+seconds the stage may run for before DeadlineExceeded is raised
+"""
+class ProgressReporter:
+    def __init__(
+        self,
+        callback: Callable[[str, float, float], None] = None,
+        token: CancelToken = None,
+        deadlines: dict[str, float] = None,
+        interval: float = 0.1
+    ):
+        self.callback = callback
+        self.token = token
+        self.deadlines = deadlines or {}
+        self.interval = interval
+
+        self.stage = None
+        self.total = 1
+        self.done = 0
+        self.start_time = 0
+        self.deadline = None
+        self.next_report = 0
+
+    # Begins a new stage made up of total units of work
+    def start(self, stage: str, total: int):
+        self.stage = stage
+        self.total = max(total, 1)
+        self.done = 0
+        self.next_report = 1
+        self.start_time = time.perf_counter()
+        stage_deadline = self.deadlines.get(stage)
+        self.deadline = self.start_time + stage_deadline if stage_deadline else None
+
+        self.check()
+        self.report(0, self.start_time)
+
+    # Marks units of work as done; cheap enough to be called in inner loops
+    def advance(self, count: int = 1):
+        self.done += count
+        if self.done >= self.next_report:
+            self.update()
+
+    def update(self):
+        now = time.perf_counter()
+        self.check(now)
+        self.report(min(self.done / self.total, 1), now)
+
+        # Estimate how many units can be done before the next report is due
+        elapsed = now - self.start_time
+        rate = self.done / elapsed if elapsed > 0 else 0
+        self.next_report = self.done + max(1, int(rate * self.interval))
+
+    def finish(self):
+        self.done = self.total
+        self.update()
+
+    # Raises if the token has been cancelled or the stage deadline has passed
+    def check(self, now: float = None):
+        if self.token and self.token.cancelled:
+            raise Cancelled(f"{self.stage} cancelled")
+        if self.deadline and (now or time.perf_counter()) > self.deadline:
+            raise DeadlineExceeded(f"{self.stage} exceeded its deadline")
+
+    def report(self, fraction: float, now: float):
+        if not self.callback:
+            return
+
+        elapsed = now - self.start_time
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else None
+        self.callback(self.stage, fraction, eta)
+
+# Progress callback that prints to the console, for use in batch mode
+def print_progress(stage: str, fraction: float, eta: float):
+    eta_text = f", {eta:.0f}s remaining" if eta is not None else ""
+    end = "\n" if fraction >= 1 else ""
+    print(f"\r{stage}: {fraction:.0%}{eta_text}".ljust(60), end=end, flush=True)
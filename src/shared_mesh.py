@@ -0,0 +1,236 @@
+import os
+import sys
+import vtk
+import vedo
+import weakref
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from vtk.util.numpy_support import vtk_to_numpy
+
+from point_data import MeshPoints, ProcessedMesh
+
+"""
+Wraps an array in the given VTK array without copying it, keeping owner alive for as long as the
+VTK array is. The references are held by an observer, which is released along with the VTK array;
+numpy_to_vtk holds them in an attribute instead, which VTK keeps after the VTK array is deleted
+"""
+def vtk_view(array: np.ndarray, vtk_array: vtk.vtkDataArray, owner: object) -> vtk.vtkDataArray:
+    vtk_array.SetNumberOfComponents(array.shape[1] if array.ndim > 1 else 1)
+    vtk_array.SetVoidArray(array, array.size, 1)
+    # Tuples release their items last to first, so the array is released before its owner
+    references = (owner, array)
+    vtk_array.AddObserver("DeleteEvent", lambda *args: references)
+
+    return vtk_array
+
+"""
+Named arrays stored in a single block of shared memory, so that they can be handed to worker
+processes without pickling. The creator passes the block's name to workers, which attach() to
+it. Only the creator unlinks the block, once all workers are done; workers only close() it.
+
+Subclasses name the integers stored at the start of the block in HEADER, and give the arrays
+stored after it in layout()
+"""
+class SharedBlock:
+    HEADER: tuple[str, ...] = ()
+
+    def __init__(self, block: shared_memory.SharedMemory):
+        self.block = block
+        header = np.ndarray((len(self.HEADER),), dtype=np.int64, buffer=block.buf)
+        self.header = dict(zip(self.HEADER, header.tolist()))
+
+        # Views onto the block; nothing is copied. Arrays from frombuffer hold an export of the
+        # mapping, so it is not unmapped while they or any views of them are still alive
+        self.arrays = {}
+        offset = header.nbytes
+        for name, dtype, shape in self.layout(self.header):
+            count = int(np.prod(shape))
+            self.arrays[name] = np.frombuffer(block.buf, dtype, count, offset).reshape(shape)
+            offset += np.dtype(dtype).itemsize * count
+
+        # Objects returned from this block, which must be released before it is closed
+        self.views = weakref.WeakSet()
+
+    @property
+    def name(self) -> str:
+        return self.block.name
+
+    # Returns (name, dtype, shape) for each array, in the order they are stored
+    @classmethod
+    def layout(cls, header: dict[str, int]) -> list[tuple[str, type, tuple]]:
+        raise NotImplementedError
+
+    # Creates a new block large enough for the arrays described by header
+    @classmethod
+    def create(cls, header: dict[str, int], name: str = None) -> "SharedBlock":
+        size = np.dtype(np.int64).itemsize * len(cls.HEADER) + sum(
+            np.dtype(dtype).itemsize * int(np.prod(shape)) for _, dtype, shape in cls.layout(header)
+        )
+        block = shared_memory.SharedMemory(name=name, create=True, size=size)
+        header_array = np.ndarray((len(cls.HEADER),), dtype=np.int64, buffer=block.buf)
+        header_array[:] = [header[key] for key in cls.HEADER]
+
+        return cls(block)
+
+    """
+    Attaches to a block created by another process. shared_tracker should be True for processes
+    started through multiprocessing by the creator, which share its resource tracker, and False
+    for unrelated processes, so that their tracker does not unlink the block when they exit
+    """
+    @classmethod
+    def attach(cls, name: str, shared_tracker: bool = True) -> "SharedBlock":
+        if sys.version_info >= (3, 13):
+            return cls(shared_memory.SharedMemory(name=name, track=False))
+
+        # Attaching registers the block with this process's resource tracker, which has no effect
+        # when the tracker is shared with the creator
+        block = shared_memory.SharedMemory(name=name)
+        if os.name == "posix" and not shared_tracker:
+            resource_tracker.unregister(block._name, "shared_memory")
+
+        return cls(block)
+
+    # Returns read-only views of the arrays, which keep this block open while they are in use
+    def read_only_arrays(self) -> dict[str, np.ndarray]:
+        arrays = {name: array.view() for name, array in self.arrays.items()}
+        for array in arrays.values():
+            array.flags.writeable = False
+
+        return arrays
+
+    # Builds a vedo mesh whose points and faces reference the block rather than copying it
+    def build_mesh(self, arrays: dict[str, np.ndarray]) -> vedo.Mesh:
+        vtk_points = vtk.vtkPoints()
+        vtk_points.SetData(vtk_view(arrays["coords"], vtk.vtkDoubleArray(), self))
+        # Cell arrays only use the given arrays rather than copying them if they are 64 bit
+        polys = vtk.vtkCellArray()
+        polys.SetData(
+            vtk_view(arrays["offsets"], vtk.vtkTypeInt64Array(), self),
+            vtk_view(arrays["connectivity"], vtk.vtkTypeInt64Array(), self)
+        )
+        pd = vtk.vtkPolyData()
+        pd.SetPoints(vtk_points)
+        pd.SetPolys(polys)
+
+        mesh = vedo.Mesh(pd)
+        mesh.shared_block = self
+        self.views.add(mesh)
+
+        return mesh
+
+    """
+    Releases this process's mapping. Raises BufferError, leaving the block mapped, while meshes or
+    points returned from it are still alive
+    """
+    def close(self):
+        if len(self.views):
+            raise BufferError(f"{self.name} is still in use and cannot be closed")
+
+        self.arrays = {}
+        try:
+            self.block.close()
+        except BufferError:
+            # Arrays taken from the returned objects are still alive. The mapping is released
+            # along with the last of them
+            raise BufferError(f"Arrays from {self.name} are still in use") from None
+
+    # Frees the block once no process needs it; only to be called by the creator
+    def unlink(self):
+        self.block.unlink()
+
+    # The arrays must be released before the block, which closes itself once no longer referenced
+    def __del__(self):
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# A vedo mesh stored in shared memory, for worker processes that only need the mesh itself
+class SharedMesh(SharedBlock):
+    HEADER = ("n_points", "n_cells", "n_connectivity")
+
+    @classmethod
+    def layout(cls, header: dict[str, int]) -> list[tuple[str, type, tuple]]:
+        return [
+            ("coords", np.float64, (header["n_points"], 3)),
+            ("offsets", np.int64, (header["n_cells"] + 1,)),
+            ("connectivity", np.int64, (header["n_connectivity"],)),
+        ]
+
+    # Copies a mesh into a new shared block, with any extra header values given
+    @classmethod
+    def share(cls, mesh: vedo.Mesh, name: str = None, **header: int) -> "SharedMesh":
+        pd = mesh.polydata()
+        coords = vtk_to_numpy(pd.GetPoints().GetData())
+        offsets = vtk_to_numpy(pd.GetPolys().GetOffsetsArray())
+        connectivity = vtk_to_numpy(pd.GetPolys().GetConnectivityArray())
+
+        shared = cls.create(
+            dict(
+                n_points=len(coords), n_cells=len(offsets) - 1,
+                n_connectivity=len(connectivity), **header
+            ),
+            name
+        )
+        shared.arrays["coords"][:] = coords
+        shared.arrays["offsets"][:] = offsets
+        shared.arrays["connectivity"][:] = connectivity
+
+        return shared
+
+    # Returns a read-only mesh backed by the shared block
+    def mesh(self) -> vedo.Mesh:
+        return self.build_mesh(self.read_only_arrays())
+
+"""
+A ProcessedMesh stored in shared memory. Workers call processed_mesh() for a read-only view of
+the vertex data, which keeps the block open for as long as it is in use
+"""
+class SharedProcessedMesh(SharedMesh):
+    HEADER = SharedMesh.HEADER + ("n_adjacency", "nasal_tip")
+
+    @classmethod
+    def layout(cls, header: dict[str, int]) -> list[tuple[str, type, tuple]]:
+        return super().layout(header) + [
+            ("fiducials", np.float64, (3 + 3 + 16,)),
+            ("adjacency_ptr", np.int64, (header["n_points"] + 1,)),
+            ("adjacency", np.int64, (header["n_adjacency"],)),
+        ]
+
+    # Copies a processed mesh into a new shared block
+    @classmethod
+    def share(cls, pro_mesh: ProcessedMesh, name: str = None) -> "SharedProcessedMesh":
+        points = pro_mesh.points
+        shared = super().share(
+            pro_mesh.mesh, name, n_adjacency=len(points.adjacency),
+            nasal_tip=pro_mesh.nasal_tip.id
+        )
+
+        arrays = shared.arrays
+        arrays["fiducials"][:] = np.concatenate([
+            np.ravel(pro_mesh.rpa), np.ravel(pro_mesh.lpa), np.ravel(pro_mesh.trans_matrix)
+        ])
+        arrays["adjacency_ptr"][:] = points.adjacency_ptr
+        arrays["adjacency"][:] = points.adjacency
+
+        return shared
+
+    # Returns a ProcessedMesh whose mesh and points are backed by the shared block
+    def processed_mesh(self) -> ProcessedMesh:
+        arrays = self.read_only_arrays()
+        points = MeshPoints(arrays["coords"], arrays["adjacency_ptr"], arrays["adjacency"], self)
+        self.views.add(points)
+        # Fiducials are small enough to copy, so that they do not hold the block open
+        fiducials = arrays["fiducials"].copy()
+
+        return ProcessedMesh(
+            self.build_mesh(arrays),
+            points,
+            points[self.header["nasal_tip"]],
+            fiducials[0:3],
+            fiducials[3:6],
+            fiducials[6:].reshape(4, 4)
+        )
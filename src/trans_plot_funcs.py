@@ -25,6 +25,10 @@ def instantiate_plotter():
 
 # Renders a point for a single-point mode
 def plot_point(evt):
+    # Fiducials cannot be changed while they are being processed
+    if transform_vars.cancel_token:
+        return
+
     select_mode = transform_vars.select_mode
     colour = transform_vars.modes[transform_vars.select_mode].color
     points = [x for x in transform_vars.plotter.actors if x.name == "Point"]
@@ -63,6 +67,8 @@ def on_key_press(evt):
         CTRL + L  : Enter LPA mode or switch back to Helmet mode
         CTRL + R  : Enter RPA mode or switch back to Helmet mode
 
+        CTRL + X  : Cancel processing of the meshes
+
     Parameters
     ----------
     evt : vedo Plotter interaction event.
@@ -72,6 +78,12 @@ def on_key_press(evt):
     None.
 
     """
+    # Cancel processing
+    if transform_vars.cancel_token:
+        if evt.keypress == "Ctrl+x":
+            transform_vars.cancel_token.cancel()
+        return
+
     # Clear Input
     if evt.keypress == "BackSpace":
         plotter = transform_vars.plotter
@@ -1,5 +1,7 @@
 import vedo
 
+from progress import CancelToken
+
 class mode:
     """
     container class for modes for easy acces in the callbacks etc
@@ -26,6 +28,7 @@ usage_txt = (
     "CTRL + L           :Left Preauricular mode\n"
     "CTRL + R           :Right Preauricular mode\n"
     "q                  :Quit point selection and continue\n"
+    "CTRL + X           :Cancel processing\n"
     "BACKSPACE          :Clear all points\n"
     "h                  :display help in console"
 )
@@ -48,6 +51,9 @@ select_mode: str
 mri_mesh: vedo.Mesh
 head_mesh: vedo.Mesh
 
+# Set while meshes are processed in the background, allowing the user to cancel
+cancel_token: CancelToken = None
+
 # Points to be collected
 mri_fiducial = {"nasal_tip": None, "lpa_pt": None, "rpa_pt": None}
 head_fiducial = {"nasal_tip": None, "lpa_pt": None, "rpa_pt": None}
@@ -0,0 +1,293 @@
+import os
+import vedo
+import numpy as np
+from typing import NamedTuple
+from multiprocessing import Pool
+
+import transform_vars
+from point_data import process_mri_mesh, process_head_mesh, fiducial_transforms
+from point_traversal import find_landmarks, LANDMARK_TOLERANCE
+from shared_mesh import SharedMesh
+from progress import ProgressReporter, DeadlineExceeded, print_progress, SAMPLING_ALIGNMENTS
+
+FIDUCIAL_KEYS = ("nasal_tip", "rpa_pt", "lpa_pt")
+LANDMARK_NAMES = (
+    "nasion", "left_endocanthion", "right_endocanthion", "forehead_left",
+    "forehead_right", "nasal_bridge", "lpa", "rpa"
+)
+# Landmarks taken directly from the jittered fiducials rather than searched for, so their spread
+# only reflects sigma
+FIDUCIAL_LANDMARKS = ("lpa", "rpa")
+
+# Meshes attached to once per worker process, as vedo meshes cannot be reliably pickled
+worker_meshes: dict[str, vedo.Mesh] = {}
+
+# Stores the outcome of a fiducial sensitivity analysis
+class UncertaintyReport(NamedTuple):
+    # Head fiducial space to MRI fiducial space, as saved in _head_fiducial_to_mri.tsv
+    head_fiducial_to_mri: np.ndarray
+    # Original head mesh space to original MRI mesh space
+    head_to_mri: np.ndarray
+    # Landmarks in the coordinate space of the original meshes
+    mri_landmarks: np.ndarray
+    head_landmarks: np.ndarray
+    excluded: np.ndarray
+    failed: np.ndarray
+
+"""
+Runs the full crop, landmark search and fit for n_samples jittered copies of the fiducials.
+progress reports the number of samples completed. deadlines maps stage names from progress
+(PROCESSING_MRI, PROCESSING_HEAD, FINDING_LANDMARKS) to the seconds each stage may take for a
+single sample, with samples that exceed them being counted as failed
+"""
+def run_uncertainty(
+    mri_mesh: vedo.Mesh,
+    head_mesh: vedo.Mesh,
+    mri_fiducial: dict[str, list[float]],
+    head_fiducial: dict[str, list[float]],
+    n_samples: int = 100,
+    sigma: float = 0.002,
+    processes: int = None,
+    seed: int = None,
+    progress: ProgressReporter = None,
+    deadlines: dict[str, float] = None
+) -> UncertaintyReport:
+    progress = progress or ProgressReporter()
+    rng = np.random.default_rng(seed)
+    mri_samples = perturb_fiducials(mri_fiducial, n_samples, sigma, rng)
+    head_samples = perturb_fiducials(head_fiducial, n_samples, sigma, rng)
+
+    # Fiducial transforms for every sample are calculated in a single batch
+    mri_tforms = fiducial_transforms(*mri_samples)
+    head_tforms = fiducial_transforms(*head_samples)
+
+    # Landmark searches traverse the mesh in Python so are spread across processes, which share a
+    # single copy of each mesh. Smoothing is unaffected by the transform into fiducial space, so
+    # the MRI is smoothed once here rather than for every sample
+    shared_meshes = (SharedMesh.share(mri_mesh.clone().smooth()), SharedMesh.share(head_mesh))
+    mesh_names = tuple(shared.name for shared in shared_meshes)
+    # Each job carries the transforms already calculated for its fiducials
+    jobs = [
+        (mri_samples[:, i], head_samples[:, i], mri_tforms[i], head_tforms[i], deadlines)
+        for i in range(n_samples)
+    ]
+    progress.start(SAMPLING_ALIGNMENTS, n_samples)
+    results = []
+    processes = processes or os.cpu_count()
+    try:
+        if processes > 1:
+            # Leaving the pool terminates the workers if the run is cancelled
+            with Pool(processes, initializer=init_worker, initargs=mesh_names) as pool:
+                chunksize = max(1, n_samples // (4*processes))
+                for result in pool.imap(sample_landmarks_job, jobs, chunksize=chunksize):
+                    results.append(result)
+                    progress.advance()
+        else:
+            init_worker(*mesh_names)
+            for job in jobs:
+                results.append(sample_landmarks(*job))
+                progress.advance()
+    finally:
+        worker_meshes.clear()
+        for shared in shared_meshes:
+            shared.close()
+            shared.unlink()
+    progress.finish()
+
+    mri_landmarks = np.array([result[0] for result in results])
+    head_landmarks = np.array([result[1] for result in results])
+
+    # Exclude landmarks that are too different between meshes, as in head_to_mri.run
+    excluded = np.linalg.norm(mri_landmarks - head_landmarks, axis=-1) > LANDMARK_TOLERANCE
+    failed = (np.sum(~excluded, axis=-1) < 3) | np.isnan(mri_landmarks).any(axis=(-2, -1))
+    fiducial_to_mri = fit_rigid(
+        np.nan_to_num(head_landmarks), np.nan_to_num(mri_landmarks), ~excluded
+    )
+    fiducial_to_mri[failed] = np.nan
+
+    # Map results back to the original mesh spaces so that samples can be compared
+    mri_inverse = np.linalg.inv(mri_tforms)
+    head_to_mri = mri_inverse @ fiducial_to_mri @ head_tforms
+
+    return UncertaintyReport(
+        fiducial_to_mri,
+        head_to_mri,
+        apply_transforms(mri_inverse, mri_landmarks),
+        apply_transforms(np.linalg.inv(head_tforms), head_landmarks),
+        excluded,
+        failed
+    )
+
+"""
+Returns fiducial coordinates with gaussian jitter of standard deviation sigma, stacked in the
+order of FIDUCIAL_KEYS with shape (3, n_samples, 3). The first sample is left unperturbed so
+that it can be used as the reference alignment
+"""
+def perturb_fiducials(
+    fiducial_points: dict[str, list[float]],
+    n_samples: int,
+    sigma: float,
+    rng: np.random.Generator
+) -> np.ndarray:
+    fiducials = np.array([fiducial_points[key] for key in FIDUCIAL_KEYS], dtype=float)
+    jitter = rng.normal(scale=sigma, size=(3, n_samples, 3))
+    jitter[:, 0] = 0
+
+    return fiducials[:, np.newaxis] + jitter
+
+# Attaches to the shared meshes, which are cloned for each sample rather than modified
+def init_worker(mri_name: str, head_name: str):
+    worker_meshes["mri"] = SharedMesh.attach(mri_name).mesh()
+    worker_meshes["head"] = SharedMesh.attach(head_name).mesh()
+
+"""
+Crops both meshes and finds landmarks for a single set of fiducials. If a stage exceeds its
+deadline the landmarks are returned as NaN
+"""
+def sample_landmarks(
+    mri_fiducial: np.ndarray,
+    head_fiducial: np.ndarray,
+    mri_tform: np.ndarray,
+    head_tform: np.ndarray,
+    deadlines: dict[str, float] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    progress = ProgressReporter(deadlines=deadlines)
+    try:
+        pro_m_mesh = process_mri_mesh(
+            worker_meshes["mri"].clone(), dict(zip(FIDUCIAL_KEYS, mri_fiducial)), progress,
+            mri_tform, smooth=False
+        )
+        pro_h_mesh = process_head_mesh(
+            worker_meshes["head"].clone(), dict(zip(FIDUCIAL_KEYS, head_fiducial)),
+            pro_m_mesh.mesh, progress, head_tform
+        )
+        mri_landmarks, head_landmarks = find_landmarks(pro_m_mesh, pro_h_mesh, progress)
+    except DeadlineExceeded:
+        missing = np.full((len(LANDMARK_NAMES), 3), np.nan)
+        return missing, missing
+
+    return np.array(mri_landmarks), np.array(head_landmarks)
+
+# Pool.imap passes a single argument to each call
+def sample_landmarks_job(job: tuple) -> tuple[np.ndarray, np.ndarray]:
+    return sample_landmarks(*job)
+
+"""
+Least squares rigid transforms mapping source landmarks onto target landmarks, solved for all
+samples at once with the Kabsch algorithm. Landmarks where mask is False are ignored
+"""
+def fit_rigid(source: np.ndarray, target: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    weights = mask[..., np.newaxis].astype(float)
+    count = np.maximum(weights.sum(axis=-2, keepdims=True), 1)
+    source_centre = (weights * source).sum(axis=-2, keepdims=True) / count
+    target_centre = (weights * target).sum(axis=-2, keepdims=True) / count
+
+    # Cross covariance of the centred landmark sets
+    covariance = np.einsum(
+        "...ni,...nj->...ij", weights * (source - source_centre), target - target_centre
+    )
+    u, _, vt = np.linalg.svd(covariance)
+
+    # Correct for reflections
+    det = np.sign(np.linalg.det(vt.swapaxes(-1, -2) @ u.swapaxes(-1, -2)))
+    correction = np.ones(u.shape[:-1])
+    correction[..., -1] = det
+    rotation = vt.swapaxes(-1, -2) @ (correction[..., np.newaxis] * u.swapaxes(-1, -2))
+
+    transform = np.zeros(source.shape[:-2] + (4, 4))
+    transform[..., :3, :3] = rotation
+    transform[..., :3, 3] = target_centre[..., 0, :] - np.einsum(
+        "...ij,...j->...i", rotation, source_centre[..., 0, :]
+    )
+    transform[..., 3, 3] = 1
+
+    return transform
+
+# Applies a stack of 4x4 transforms to a stack of point sets
+def apply_transforms(transforms: np.ndarray, points: np.ndarray) -> np.ndarray:
+    return np.einsum("...ij,...nj->...ni", transforms[..., :3, :3], points) \
+        + transforms[..., np.newaxis, :3, 3]
+
+# Returns the rotation angle in degrees between each transform and a reference transform
+def rotation_deviation(transforms: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    relative = transforms[..., :3, :3] @ reference[:3, :3].T
+    cos_angle = (np.trace(relative, axis1=-2, axis2=-1) - 1) / 2
+
+    return np.degrees(np.arccos(np.clip(cos_angle, -1, 1)))
+
+# Summarises the spread of the alignment across samples, in millimetres and degrees
+def summarise(report: UncertaintyReport) -> str:
+    valid = ~report.failed
+    lines = [
+        f"Samples: {len(report.failed)} ({np.sum(report.failed)} failed from too few usable "
+        "landmarks or exceeding a deadline)"
+    ]
+    if not valid.any():
+        return lines[0]
+
+    for name, all_transforms in (
+        ("Head fiducial to MRI", report.head_fiducial_to_mri),
+        ("Head to MRI", report.head_to_mri)
+    ):
+        # Deviations are measured from the unperturbed first sample
+        if report.failed[0]:
+            lines.append(f"{name}: unperturbed sample failed, no reference alignment available")
+            continue
+        reference = all_transforms[0]
+        transforms = all_transforms[valid]
+        translation = (transforms[:, :3, 3] - reference[:3, 3]) * 1000
+        rotation = rotation_deviation(transforms, reference)
+        lines.append(
+            f"{name}: translation std (mm) x={translation[:, 0].std():.2f} "
+            f"y={translation[:, 1].std():.2f} z={translation[:, 2].std():.2f}, "
+            f"max shift {np.linalg.norm(translation, axis=-1).max():.2f} mm; "
+            f"rotation mean {rotation.mean():.2f} deg, max {rotation.max():.2f} deg"
+        )
+
+    lines.append(f"{'Landmark':<20}{'MRI std (mm)':>14}{'Head std (mm)':>15}{'Excluded':>10}")
+    mri_spread = np.linalg.norm(report.mri_landmarks[valid].std(axis=0), axis=-1) * 1000
+    head_spread = np.linalg.norm(report.head_landmarks[valid].std(axis=0), axis=-1) * 1000
+    exclusion_rate = report.excluded[valid].mean(axis=0) * 100
+    for index, name in enumerate(LANDMARK_NAMES):
+        if name in FIDUCIAL_LANDMARKS:
+            spread = f"{'(input fiducial)':>29}"
+        else:
+            spread = f"{mri_spread[index]:>14.2f}{head_spread[index]:>15.2f}"
+        lines.append(f"{name:<20}{spread}{exclusion_rate[index]:>9.0f}%")
+
+    return "\n".join(lines)
+
+# Saves per-sample transforms so that the spread can be inspected outside of the program
+def save_report(report: UncertaintyReport, path: str):
+    np.savetxt(
+        path+"_head_fiducial_to_mri_samples.tsv",
+        report.head_fiducial_to_mri.reshape(-1, 16), delimiter='\t'
+    )
+    np.savetxt(
+        path+"_head_to_mri_samples.tsv", report.head_to_mri.reshape(-1, 16), delimiter='\t'
+    )
+
+# Takes fiducial input and runs the sensitivity analysis, see run_uncertainty for arguments
+def run(n_samples: int = 100, sigma: float = 0.002, deadlines: dict[str, float] = None):
+    from head_to_mri import load_meshes
+    from trans_plot_funcs import instantiate_plotter
+
+    path = load_meshes()
+
+    # Take user input for prearicular points and nasal tip underside
+    instantiate_plotter()
+    transform_vars.plotter.show(
+        title="Press q when done", size="fullscreen"
+    ).interactive()
+    transform_vars.plotter.close()
+
+    report = run_uncertainty(
+        transform_vars.mri_mesh, transform_vars.head_mesh,
+        transform_vars.mri_fiducial, transform_vars.head_fiducial, n_samples, sigma,
+        progress=ProgressReporter(print_progress), deadlines=deadlines
+    )
+    print(summarise(report))
+    save_report(report, path)
+
+if __name__ == "__main__":
+    run()
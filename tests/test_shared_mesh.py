@@ -0,0 +1,93 @@
+import gc
+import os
+import sys
+import vedo
+import pytest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from point_data import ProcessedMesh, extract_point_data_and_ntip
+from shared_mesh import SharedMesh, SharedProcessedMesh
+
+@pytest.fixture
+def pro_mesh() -> ProcessedMesh:
+    mesh = vedo.Sphere(res=24).triangulate()
+    points, nasal_tip = extract_point_data_and_ntip(mesh, [0, 0, 0])
+    trans_matrix = np.arange(16, dtype=float).reshape(4, 4)
+
+    return ProcessedMesh(mesh, points, nasal_tip, [1, 2, 3], [4, 5, 6], trans_matrix)
+
+# Shares pro_mesh for the duration of a test, unlinking the block afterwards
+@pytest.fixture
+def shared(pro_mesh: ProcessedMesh):
+    shared = SharedProcessedMesh.share(pro_mesh)
+    yield shared
+    gc.collect()
+    shared.close()
+    shared.unlink()
+
+def test_round_trip(pro_mesh: ProcessedMesh, shared: SharedProcessedMesh):
+    attached = SharedProcessedMesh.attach(shared.name)
+    view = attached.processed_mesh()
+
+    assert np.array_equal(view.points.coords, pro_mesh.points.coords)
+    assert np.array_equal(view.points.adjacency_ptr, pro_mesh.points.adjacency_ptr)
+    assert np.array_equal(view.points.adjacency, pro_mesh.points.adjacency)
+    assert view.points[7].connected_points == pro_mesh.points[7].connected_points
+    assert view.nasal_tip.id == pro_mesh.nasal_tip.id
+    assert np.array_equal(view.rpa, pro_mesh.rpa)
+    assert np.array_equal(view.lpa, pro_mesh.lpa)
+    assert np.array_equal(view.trans_matrix, pro_mesh.trans_matrix)
+    assert view.mesh.npoints == pro_mesh.mesh.npoints
+    assert view.mesh.ncells == pro_mesh.mesh.ncells
+    assert np.array_equal(view.mesh.points(), pro_mesh.mesh.points())
+    assert not view.points.coords.flags.writeable
+
+    del view
+    gc.collect()
+    attached.close()
+
+# The view keeps the block mapped after the handle it came from is no longer referenced
+def test_view_outlives_handle(pro_mesh: ProcessedMesh, shared: SharedProcessedMesh):
+    view = SharedProcessedMesh.attach(shared.name).processed_mesh()
+    gc.collect()
+
+    assert np.array_equal(view.points.coords, pro_mesh.points.coords)
+    assert np.array_equal(view.mesh.points(), pro_mesh.mesh.points())
+
+def test_close_refused_while_view_alive(pro_mesh: ProcessedMesh, shared: SharedProcessedMesh):
+    attached = SharedProcessedMesh.attach(shared.name)
+    view = attached.processed_mesh()
+    with pytest.raises(BufferError):
+        attached.close()
+    assert np.array_equal(view.mesh.points(), pro_mesh.mesh.points())
+
+    del view
+    gc.collect()
+    attached.close()
+
+def test_close_refused_while_array_alive(pro_mesh: ProcessedMesh, shared: SharedProcessedMesh):
+    attached = SharedProcessedMesh.attach(shared.name)
+    coords = attached.processed_mesh().points.coords[:5]
+    gc.collect()
+    with pytest.raises(BufferError):
+        attached.close()
+    assert np.array_equal(coords, pro_mesh.points.coords[:5])
+
+    del coords
+    gc.collect()
+    attached.close()
+
+def test_shared_mesh_clone(pro_mesh: ProcessedMesh):
+    shared = SharedMesh.share(pro_mesh.mesh)
+    mesh = SharedMesh.attach(shared.name).mesh()
+    clone = mesh.clone().smooth()
+
+    assert clone.npoints == pro_mesh.mesh.npoints
+    assert np.array_equal(mesh.points(), pro_mesh.mesh.points())
+
+    del mesh, clone
+    gc.collect()
+    shared.close()
+    shared.unlink()